@@ -5,6 +5,8 @@ import json
 import requests
 from huggingface_hub import HfApi
 
+TRACKED_EXTS = ('.ckpt', '.safetensors')
+
 
 def print_error(message):
     """Prints the message in red."""
@@ -45,6 +47,21 @@ def upload_file_to_hf(file_path, hfuser, hfrepo, hffolder, max_attempts=3):
     return False  # Failed all attempts
 
 
+def scan_tracked_files(directory):
+    """Yields DirEntry objects of tracked files, the directory and file type checks come from the scandir entries."""
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        # Unreadable directories are skipped silently, like os.walk does
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_tracked_files(entry.path)
+            elif entry.name.endswith(TRACKED_EXTS) and entry.is_file():
+                yield entry
+
+
 def monitor_and_upload(base_dir, hfuser, hfrepo, hffolder, N=3, sleep_interval=15 * 60, max_attempts=3):
     if not os.path.exists(base_dir):
         print_error(f"The provided base directory '{base_dir}' does not exist.")
@@ -54,17 +71,9 @@ def monitor_and_upload(base_dir, hfuser, hfrepo, hffolder, N=3, sleep_interval=1
     uploaded_files_list = []
 
     while True:
-        # Create a list to track all the ckpt and safetensors files
-        all_files = []
-
-        # Walk through the base directory to locate all the ckpt and safetensors files
-        for dirpath, _, filenames in os.walk(base_dir):
-            for file in filenames:
-                if file.endswith('.ckpt') or file.endswith('.safetensors'):
-                    all_files.append(os.path.join(dirpath, file))
-
-        # Sort files by modification time
-        all_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
+        # Locate all the ckpt and safetensors files, sorted by modification time
+        all_entries = sorted(scan_tracked_files(base_dir), key=lambda entry: entry.stat().st_mtime, reverse=True)
+        all_files = [entry.path for entry in all_entries]
 
         all_uploaded = True  # Assume all files are uploaded
 
@@ -877,10 +877,10 @@ class ImageDropWidget(QWidget):
             #     else:
             #         print(f"{path} already exists in the widget!")
 
-    supported_formats_list = ['jpg', 'jpeg', 'png', 'bmp', 'tiff', 'webp']
+    supported_formats_list = ('jpg', 'jpeg', 'png', 'bmp', 'tiff', 'webp')
     def is_supported_image_format(self, file_name):
 
-        return any(file_name.lower().endswith(ext) for ext in self.supported_formats_list)
+        return file_name.lower().endswith(self.supported_formats_list)
 
 
     def dropEvent(self, event):
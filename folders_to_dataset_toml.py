@@ -4,7 +4,7 @@ import re
 import json
 
 # Supported image extensions
-IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff')
 
 FOLDER_SETTINGS_FILE_NAME = "folder_settings.json"
 
@@ -12,7 +12,7 @@ def has_images(folder_path):
     """Check if the folder contains any image files."""
     try:
         for filename in os.listdir(folder_path):
-            if any(filename.endswith(ext) for ext in IMAGE_EXTENSIONS):
+            if filename.endswith(IMAGE_EXTENSIONS):
                 return True
     except PermissionError:
         print(f"Warning: No permission to access {folder_path}. Skipping.")
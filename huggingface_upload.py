@@ -3,19 +3,37 @@ import hashlib
 import os
 import json
 import logging
-from huggingface_hub import HfApi
+from huggingface_hub import HfApi, CommitOperationAdd
 from tqdm import tqdm
 import concurrent.futures
 import time
 import threading
-from tqdm.contrib.concurrent import thread_map
-import queue
 import psutil
+import requests
 from collections import deque
 from threading import Lock
 import glob
-
-progress_updates = queue.Queue()
+import re
+
+# Files per commit: starts at 50 and moves along the scale, up after quick
+# commits and down when a commit times out. A size that timed out is not
+# tried again during the run, rate limits only back off.
+COMMIT_BATCH_SIZES = [20, 50, 75, 100, 125, 150, 200, 250, 400, 600, 1000]
+COMMIT_FAST_SECONDS = 40
+# Attempts for a commit the Hub keeps rejecting as overloaded, with backoff from 30s up to 10 minutes
+COMMIT_OVERLOADED_ATTEMPTS = 6
+# Rate limited, unavailable and gateway timeout, other errors are not worth waiting for
+HUB_OVERLOADED_STATUS_CODES = (429, 503, 504)
+# Building a CommitOperationAdd hashes the file, hashlib releases the GIL so files hash in parallel
+HASH_THREADS = min(8, os.cpu_count() or 1)
+# Parallel LFS uploads per commit, uploads wait on the network so this goes above the core count
+UPLOAD_THREADS = min(32, (os.cpu_count() or 4) * 2)
+
+# Bytes committed so far, read by manage_progress_bar, which polls instead of waiting on a queue
+uploaded_bytes = 0
+uploaded_bytes_lock = Lock()
+uploads_done = threading.Event()
+PROGRESS_POLL_SECONDS = 0.1
 stdout_lock = Lock()
 progress_estimation_lock = Lock()
 
@@ -82,20 +100,15 @@ class UploadMonitor(threading.Thread):
         self.running = False
         self.upload_pbar.close()
 
+    # Only the counters change here, run() redraws the bar once per second
     def add_file(self, file_size):
-        self.total_size += file_size
-        self.total_size = max(self.total_size, 0)
         with progress_estimation_lock:
-            self.upload_pbar.total = self.total_size / 1024 / 1024
-            self.upload_pbar.refresh()
+            self.total_size = max(self.total_size + file_size, 0)
 
     def finish_file(self, file_size):
-        self.total_size = max(0, self.total_size - file_size)
-        self.uploaded_size = max(0, self.uploaded_size - file_size)
         with progress_estimation_lock:
-            self.upload_pbar.n = self.uploaded_size / (1024 * 1024)
-            self.upload_pbar.total = self.total_size / 1024 / 1024
-            self.upload_pbar.refresh()
+            self.total_size = max(0, self.total_size - file_size)
+            self.uploaded_size = max(0, self.uploaded_size - file_size)
 
     def set_speed(self, speed):
         self.speed_bytes = speed
@@ -108,7 +121,7 @@ def get_args():
     parser.add_argument("--repository", required=False, help="Repository on huggingface.com")
     parser.add_argument("--token_file", required=False, help="File containing your Hugging Face token")
     parser.add_argument("--remove", action="store_true", help="Remove files after upload")
-    parser.add_argument("--threads", type=int, default=3, help='Number of threads for parallel processing.')
+    parser.add_argument("--threads", type=int, default=None, help=f'Number of parallel uploads, default {UPLOAD_THREADS}.')
     return parser.parse_args()
 
 logging.basicConfig(level=logging.INFO)
@@ -121,46 +134,99 @@ def compute_sha256(filepath, chunk_size=8192):
             hash_sha256.update(chunk)
     return hash_sha256.hexdigest()
 
-def upload_file(filepath, path_in_repository, repo_id, token, api, progress_bar_lock, base_source_folder, remove=False):
-    relative_path = os.path.relpath(filepath, start=base_source_folder)
-    path_in_repo = os.path.join(path_in_repository, relative_path)
-    repo_files = api.list_repo_files(repo_id=repo_id, token=token)
-    full_path_in_repo = path_in_repo.strip('/')
-
-    if full_path_in_repo in repo_files:
-        logger.info(f"File {filepath} already exists in the repository. Skipping upload.")
-        return
-
-    for attempt in range(1, 4):
+def is_hub_overloaded(error):
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code in HUB_OVERLOADED_STATUS_CODES
+
+# upload_batch results, BATCH_SHRINK asks for the batch to be retried with fewer
+# files, BATCH_OVERLOADED means the Hub stayed overloaded through every backoff
+BATCH_COMMITTED = 'committed'
+BATCH_FAILED = 'failed'
+BATCH_SHRINK = 'shrink'
+BATCH_OVERLOADED = 'overloaded'
+
+def is_commit_too_large(error):
+    # A commit that timed out may go through with fewer files, 429 and 503 only ask to slow down
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 504
+
+def overloaded_delay(attempt):
+    return min(30 * 2 ** (attempt - 1), 600)
+
+def upload_batch(batch, operations, repo_id, api, threads, failed_files, remove=False, max_attempts=3):
+    # Returns (result, commit_seconds), result is one of the BATCH_ values.
+    global uploaded_bytes
+    # Operations are kept across calls, so files are hashed and their LFS blobs uploaded only once.
+
+    # Each file is hashed on its own, one that was deleted or became unreadable
+    # after the walk is left out and the rest of the batch is still committed
+    missing = [(filepath, path_in_repo, file_size) for filepath, path_in_repo, file_size in batch if path_in_repo not in operations]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+        futures = [(filepath, path_in_repo, file_size, executor.submit(CommitOperationAdd, path_in_repo=path_in_repo, path_or_fileobj=filepath))
+                   for filepath, path_in_repo, file_size in missing]
+        for filepath, path_in_repo, file_size, future in futures:
+            try:
+                operations[path_in_repo] = future.result()
+            except Exception as e:
+                logger.error(f"Skipping {filepath}: {e}")
+                failed_files.append((filepath, str(e)))
+                upload_monitor.finish_file(file_size)
+    batch = [(filepath, path_in_repo, file_size) for filepath, path_in_repo, file_size in batch if path_in_repo in operations]
+    if not batch:
+        return BATCH_FAILED, None
+
+    for attempt in range(1, COMMIT_OVERLOADED_ATTEMPTS + 1):
         try:
-            with open(filepath, "rb") as file:
-                response = api.upload_file(
-                    path_or_fileobj=file,
-                    path_in_repo=path_in_repo,
-                    repo_id=repo_id,
-                    repo_type=None,
-                    token=token,
-                    create_pr=True,
-                )
-            with progress_bar_lock:
-                progress_updates.put(os.path.getsize(filepath))
-                upload_monitor.finish_file(os.path.getsize(filepath))
-            if response and isinstance(response, str) and response.startswith("https://"):
-                logger.info(f"File {filepath} uploaded successfully.")
-                if remove:
-                    os.remove(filepath)
-                    logger.info(f"File {filepath} deleted locally.")
-            else:
-                logger.info(f"Failed to upload file {filepath}.")
+            commit_operations = [operations[path_in_repo] for _, path_in_repo, _ in batch]
+            # LFS blobs are uploaded first, so only the commit itself is timed to size the next batch
+            api.preupload_lfs_files(repo_id, additions=commit_operations, create_pr=True, num_threads=threads)
+            commit_started = time.monotonic()
+            commit_info = api.create_commit(
+                repo_id=repo_id,
+                repo_type=None,
+                operations=commit_operations,
+                commit_message=f"Upload {len(batch)} files",
+                create_pr=True,
+                num_threads=threads,
+            )
+            commit_seconds = time.monotonic() - commit_started
             break
         except Exception as e:
-            logger.exception(f"Error uploading {filepath}: {e}")
-            if attempt == 3:
-                logger.exception(f"Failed to upload {filepath} after {attempt} attempts")
-                break
-    upload_monitor.finish_file(os.path.getsize(filepath))
-
-def upload_files(config, path_in_repository, valid_files_paths, base_source_folder):
+            if is_hub_overloaded(e):
+                if is_commit_too_large(e) and len(batch) > COMMIT_BATCH_SIZES[0]:
+                    logger.warning(f"Commit of {len(batch)} files timed out, retrying with fewer files: {e}")
+                    return BATCH_SHRINK, None
+                if attempt < COMMIT_OVERLOADED_ATTEMPTS:
+                    delay = overloaded_delay(attempt)
+                    logger.warning(f"Hub overloaded while committing {len(batch)} files, retrying in {delay} seconds: {e}")
+                    time.sleep(delay)
+                    continue
+                logger.error(f"Hub still overloaded after {attempt} attempts, giving up on {len(batch)} files: {e}")
+                return BATCH_OVERLOADED, None
+            logger.exception(f"Error uploading {len(batch)} files: {e}")
+            if attempt >= max_attempts:
+                logger.error(f"Failed to upload {len(batch)} files after {attempt} attempts")
+                return BATCH_FAILED, None
+
+    with uploaded_bytes_lock:
+        uploaded_bytes += sum(file_size for _, _, file_size in batch)
+    logger.info(f"{len(batch)} files uploaded successfully: {commit_info.pr_url}")
+    for filepath, _, file_size in batch:
+        upload_monitor.finish_file(file_size)
+        # The commit went through, a file that can't be deleted doesn't make it fail
+        if remove:
+            try:
+                os.remove(filepath)
+                logger.info(f"File {filepath} deleted locally.")
+            except OSError as e:
+                logger.error(f"Could not delete {filepath}: {e}")
+    return BATCH_COMMITTED, commit_seconds
+
+def upload_files(config, upload_paths):
     try:
         with open(config['token_file'], "r") as token_file:
             token = token_file.read().strip()
@@ -168,24 +234,182 @@ def upload_files(config, path_in_repository, valid_files_paths, base_source_fold
         logger.exception(f"Token file {config['token_file']}: {e}")
         return
 
-    api = HfApi()
+    # One client carries the token for every call of the run
+    api = HfApi(token=token)
     repo_id = config['repository']
-    progress_bar_lock = Lock()
-
-    upload_func = lambda filepath: upload_file(filepath, path_in_repository, repo_id, token, api, progress_bar_lock, base_source_folder, remove=config.get('remove', False))
-
-    thread_map(upload_func, valid_files_paths, max_workers=config.get('threads', 3))
-    progress_updates.put(None)
+    repo_files = set(api.list_repo_files(repo_id=repo_id))
+
+    # Files of all sources are grouped into a few large commits instead of one commit and PR per file
+    pending_files = []
+    for path_in_repo, (filepath, file_size) in upload_paths.items():
+        if path_in_repo in repo_files:
+            logger.info(f"File {filepath} already exists in the repository. Skipping upload.")
+            continue
+        pending_files.append((filepath, path_in_repo, file_size))
+
+    operations = {}
+    failed_files = []
+    # Halves of batches whose commit failed, split until the files that sink a commit are found
+    split_batches = []
+    batch_size_index = COMMIT_BATCH_SIZES.index(50)
+    max_batch_size_index = len(COMMIT_BATCH_SIZES) - 1
+    overloaded_commits = 0
+    while split_batches or pending_files:
+        if split_batches:
+            # The full batch already used its retries, each half gets one attempt
+            batch = split_batches.pop()
+            max_attempts = 1
+        else:
+            batch = pending_files[:COMMIT_BATCH_SIZES[batch_size_index]]
+            pending_files = pending_files[len(batch):]
+            max_attempts = 3
+        result, commit_seconds = upload_batch(batch, operations, repo_id, api, config.get('threads', UPLOAD_THREADS),
+                                              failed_files, remove=config.get('remove', False), max_attempts=max_attempts)
+        # Files that failed to hash are already in failed_files
+        batch = [entry for entry in batch if entry[1] in operations]
+        if result == BATCH_SHRINK:
+            # Wait before the smaller batch too, the Hub is still struggling
+            overloaded_commits += 1
+            max_batch_size_index = max(batch_size_index - 1, 0)
+            batch_size_index //= 2
+            delay = overloaded_delay(overloaded_commits)
+            logger.warning(f"Retrying with {COMMIT_BATCH_SIZES[batch_size_index]} files per commit in {delay} seconds")
+            time.sleep(delay)
+            pending_files = batch + pending_files
+        elif result == BATCH_COMMITTED:
+            overloaded_commits = 0
+            if commit_seconds < COMMIT_FAST_SECONDS:
+                batch_size_index = min(batch_size_index + 1, max_batch_size_index)
+        elif result == BATCH_OVERLOADED:
+            # Splitting would only send more commits to a Hub that keeps rejecting them
+            logger.error("The Hub stayed overloaded, stopping the upload")
+            unsent = batch + [entry for split_batch in split_batches for entry in split_batch] + pending_files
+            for filepath, _, file_size in unsent:
+                failed_files.append((filepath, "not uploaded, the Hub stayed overloaded"))
+                upload_monitor.finish_file(file_size)
+            break
+        elif len(batch) > 1:
+            half = len(batch) // 2
+            split_batches += [batch[half:], batch[:half]]
+        elif batch:
+            filepath, _, file_size = batch[0]
+            failed_files.append((filepath, "commit failed, see the errors above"))
+            upload_monitor.finish_file(file_size)
+    uploads_done.set()
+    if failed_files:
+        logger.error(f"{len(failed_files)} files were not uploaded:")
+        for filepath, error in failed_files:
+            logger.error(f"{filepath}: {error}")
     logger.info("DONE")
     logger.info("Go to your repo and accept the PRs this created to see your files")
 
 def manage_progress_bar(progress_bar):
+    shown = 0
     while True:
-        update = progress_updates.get()
-        if update is None:
+        finished = uploads_done.wait(PROGRESS_POLL_SECONDS)
+        with uploaded_bytes_lock:
+            uploaded = uploaded_bytes
+        if uploaded > shown:
+            with stdout_lock:
+                progress_bar.update(uploaded - shown)
+            shown = uploaded
+        if finished:
             break
-        with stdout_lock:
-            progress_bar.update(update)
+
+def translate_file_pattern(segments):
+    # Same rules as glob.glob(recursive=True): "*" stays inside one directory,
+    # "**" spans directories and wildcards never match hidden names
+    parts = []
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == '**':
+            parts.append(r'(?:(?!\.)[^/]+/)*' + (r'(?!\.)[^/]+' if last else ''))
+            continue
+        part = '' if segment.startswith('.') else r'(?!\.)'
+        i = 0
+        while i < len(segment):
+            char = segment[i]
+            i += 1
+            if char == '*':
+                part += '[^/]*'
+            elif char == '?':
+                part += '[^/]'
+            elif char == '[':
+                end = i
+                if end < len(segment) and segment[end] == '!':
+                    end += 1
+                if end < len(segment) and segment[end] == ']':
+                    end += 1
+                end = segment.find(']', end)
+                if end == -1:
+                    part += re.escape(char)
+                    continue
+                chars = segment[i:end].replace('\\', '\\\\')
+                i = end + 1
+                if chars[0] == '!':
+                    chars = '^' + chars[1:]
+                elif chars[0] in ('^', '['):
+                    chars = '\\' + chars
+                part += f'[{chars}]'
+            else:
+                part += re.escape(char)
+        parts.append(part + ('' if last else '/'))
+    return ''.join(parts)
+
+def scan_matching_files(directory, relative_dir, pattern, max_depth):
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            relative_path = relative_dir + entry.name
+            if entry.is_dir():
+                if max_depth is None or max_depth > 1:
+                    yield from scan_matching_files(entry.path, relative_path + '/', pattern,
+                                                   None if max_depth is None else max_depth - 1)
+            elif pattern.match(relative_path) and entry.is_file():
+                yield entry.path, entry.stat().st_size
+
+def expand_file_patterns(base_source_folder, file_patterns):
+    # Patterns sharing a literal leading directory are matched in a single
+    # os.scandir walk instead of one recursive glob.glob per pattern.
+    # Returns {filepath: size}, each file is stat'ed once.
+    matched_files = {}
+    walks = {}
+    for file_pattern in file_patterns:
+        segments = [segment for segment in file_pattern.replace(os.sep, '/').split('/') if segment != '.']
+        translated = None
+        if not (os.path.isabs(file_pattern) or '..' in segments or not glob.has_magic(file_pattern)):
+            literal_count = 0
+            while not glob.has_magic(segments[literal_count]):
+                literal_count += 1
+            translated = translate_file_pattern(segments[literal_count:])
+            try:
+                re.compile(translated)
+            except re.error:
+                # Classes glob accepts but re rejects, like [z-a], are left to glob.glob
+                translated = None
+        if translated is None:
+            for filepath in glob.glob(os.path.join(base_source_folder, file_pattern), recursive=True):
+                if os.path.isfile(filepath):
+                    matched_files[filepath] = os.path.getsize(filepath)
+                else:
+                    logger.warning(f"File {filepath} does not exist.")
+            continue
+        literal_segments = tuple(segments[:literal_count])
+        walk = walks.setdefault(literal_segments, {'patterns': [], 'max_depth': 0})
+        walk['patterns'].append(translated)
+        if walk['max_depth'] is not None:
+            depth = len(segments) - literal_count
+            walk['max_depth'] = None if '**' in segments else max(walk['max_depth'], depth)
+
+    for literal_segments, walk in walks.items():
+        # One alternation regex tests all patterns of the walk in a single match
+        pattern = re.compile('(?:' + '|'.join(walk['patterns']) + r')\Z', re.IGNORECASE if os.name == 'nt' else 0)
+        walk_root = os.path.join(base_source_folder, *literal_segments)
+        matched_files.update(scan_matching_files(walk_root, '', pattern, walk['max_depth']))
+    return matched_files
 
 def main():
     args = get_args()
@@ -220,38 +444,38 @@ def main():
     speed_monitor.start()
     upload_monitor.start()
 
-    total_size = 0
-    all_valid_files_paths = []
+    upload_paths = {}
 
     for source_config in config['sources']:
         base_source_folder = source_config['source_base']
         path_in_repository = source_config['path_in_repository']
         file_patterns = source_config['files']
 
-        expanded_file_list = []
-        for file_pattern in file_patterns:
-            matched_files = glob.glob(os.path.join(base_source_folder, file_pattern), recursive=True)
-            expanded_file_list.extend(matched_files)
-
-        expanded_file_list = list(set(expanded_file_list))
+        file_sizes = expand_file_patterns(base_source_folder, file_patterns)
 
-        valid_files_paths = []
-        for filepath in expanded_file_list:
-            if os.path.isfile(filepath):
-                total_size += os.path.getsize(filepath)
-                valid_files_paths.append(filepath)
+        # Matched paths are joined onto the source base, so slicing the prefix off
+        # replaces os.path.relpath (two abspath calls per file) for all but absolute patterns
+        base_prefix = os.path.join(base_source_folder, '')
+        for filepath, file_size in file_sizes.items():
+            if filepath.startswith(base_prefix):
+                relative_path = os.path.normpath(filepath[len(base_prefix):])
             else:
-                logger.warning(f"File {filepath} does not exist.")
+                relative_path = os.path.relpath(filepath, start=base_source_folder)
+            path_in_repo = os.path.join(path_in_repository, relative_path).strip('/')
+            # Sizes from the walk are passed along, upload workers don't stat again
+            kept_filepath, _ = upload_paths.setdefault(path_in_repo, (filepath, file_size))
+            if kept_filepath != filepath:
+                logger.warning(f"{filepath} and {kept_filepath} both go to {path_in_repo}, only {kept_filepath} is uploaded.")
 
-        all_valid_files_paths.append((path_in_repository, valid_files_paths, base_source_folder))
+    total_size = sum(file_size for _, file_size in upload_paths.values())
 
     progress_bar = tqdm(total=total_size, unit="MB", unit_scale=True, ncols=160, colour='red')
 
     thread_manage_progress_bar = threading.Thread(target=manage_progress_bar, args=(progress_bar,), daemon=True)
     thread_manage_progress_bar.start()
 
-    for path_in_repository, valid_files_paths, base_source_folder in all_valid_files_paths:
-        upload_files(config, path_in_repository, valid_files_paths, base_source_folder)
+    # All sources go to the same repository, so they share commits
+    upload_files(config, upload_paths)
 
     thread_manage_progress_bar.join()
 
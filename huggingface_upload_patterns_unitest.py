@@ -0,0 +1,72 @@
+import os
+import glob
+import tempfile
+from argparse import ArgumentParser
+from huggingface_upload import expand_file_patterns
+
+SAMPLE_FILES = ['a.txt', '.h.txt', 'b.bin', 'z]1.txt', '.hd/a.txt', 'd1/a.txt', 'd1/x.safetensors', 'd1/.hid/a.txt',
+                'd1/d2/a.txt', 'd1/d2/c[1].txt', 'd1/d2/e!.bin', 'd1/d2/-x.txt', 'd3/f.txt', 'd3/sub/g.txt',
+                'd3/sub/deep/h.txt']
+
+SAMPLE_PATTERNS = ['*.txt', '**/*.txt', '**', 'd1/**', 'd1/*/*.txt', '*/a.txt', '.*', '.hd/*', '**/.hid/*',
+                   'd1/d2/c[[]1].txt', '[!a]*.bin', 'd3/**/h.txt', '**/*.safetensors', 'd?/*', 'd1/d2/[!]]*',
+                   '[]z]*', 'd3/*', 'missing/**/*', 'a.txt', '*/d2/[-a]*', 'd1/d2/*!*', '[z-a].txt', 'd1/[z-a]*']
+
+def create_sample_files(folder):
+    for sample_file in SAMPLE_FILES:
+        filepath = os.path.join(folder, sample_file)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        open(filepath, 'w').close()
+
+def glob_files(folder, file_patterns):
+    # What expand_file_patterns replaced: one recursive glob.glob per pattern
+    files = set()
+    for file_pattern in file_patterns:
+        files.update(filepath for filepath in glob.glob(os.path.join(folder, file_pattern), recursive=True)
+                     if os.path.isfile(filepath))
+    return files
+
+def test_file_patterns(folder, file_patterns):
+    expected_files = glob_files(folder, file_patterns)
+    matched_files = set(expand_file_patterns(folder, file_patterns))
+    equal_files = matched_files == expected_files
+
+    color_code = "\033[32m" if equal_files else "\033[31m"
+    reset_code = "\033[0m"
+    if False == equal_files:
+        missing = sorted(os.path.relpath(filepath, folder) for filepath in expected_files - matched_files)
+        extra = sorted(os.path.relpath(filepath, folder) for filepath in matched_files - expected_files)
+        print(f"{color_code}{file_patterns}{reset_code} - Missing: {missing}, Extra: {extra}")
+
+    return not equal_files
+
+def main():
+    parser = ArgumentParser(description='Compare expand_file_patterns with glob.glob')
+    parser.add_argument("-f", "--folder", dest="folder", help="Folder to match the patterns in, a sample folder is created by default.")
+    parser.add_argument("-p", "--patterns", nargs='+', default=SAMPLE_PATTERNS, help="Patterns to compare.")
+
+    args = parser.parse_args()
+
+    if args.folder:
+        folder = args.folder
+    else:
+        folder = tempfile.mkdtemp()
+        create_sample_files(folder)
+
+    mismatched_patterns = 0
+    for file_pattern in args.patterns:
+        if test_file_patterns(folder, [file_pattern]):
+            mismatched_patterns += 1
+    # All patterns together, as the sources of the upload settings pass them
+    if test_file_patterns(folder, args.patterns):
+        mismatched_patterns += 1
+
+    print(f"Number of mismatched patterns: {mismatched_patterns} / {len(args.patterns) + 1}")
+
+
+if __name__ == "__main__":
+    main()
+
+
+# python3 huggingface_upload_patterns_unitest.py
+# python3 huggingface_upload_patterns_unitest.py --folder "/path/to/your/folder" --patterns "**/*.safetensors" "*.txt"
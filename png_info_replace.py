@@ -125,10 +125,10 @@ def save_exif(input_image_path, output_image_path, exif_data):
 import os
 
 def get_image_files(input_folder):
-    supported_formats = ['.jpg', '.jpeg', '.png', '.tiff', '.bmp']
+    supported_formats = ('.jpg', '.jpeg', '.png', '.tiff', '.bmp')
     image_files = []
     for file in os.listdir(input_folder):
-        if any(file.lower().endswith(ext) for ext in supported_formats):
+        if file.lower().endswith(supported_formats):
             image_files.append(os.path.join(input_folder, file))
     return image_files
 
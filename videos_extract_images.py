@@ -3,9 +3,9 @@ import subprocess
 import argparse
 
 # Function to check if a file is a video
-VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv'}
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv')
 def is_video_file(filename):
-    return any(filename.lower().endswith(ext) for ext in VIDEO_EXTENSIONS)
+    return filename.lower().endswith(VIDEO_EXTENSIONS)
 
 # Function to extract frames from a video
 def extract_frames(video_path, output_dir, interval):